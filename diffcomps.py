@@ -1,130 +1,163 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import argparse
-from collections import defaultdict, namedtuple
-import json
+from collections import defaultdict
 import logging
-logging.basicConfig(level=logging.DEBUG)
-from operator import itemgetter
 import sys
-import time
-import xml.etree.ElementTree as ElementTree
+from sys import intern
+from time import perf_counter
+try:
+    from lxml import etree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+try:
+    import orjson
 
+    def dump_json(obj, fp):
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 |
+                            orjson.OPT_APPEND_NEWLINE |
+                            orjson.OPT_NON_STR_KEYS)
+        buffer = getattr(fp, 'buffer', None)
+        if buffer is None:
+            # Text stream without a binary layer, e.g. io.StringIO.
+            fp.write(data.decode())
+        else:
+            fp.flush()
+            buffer.write(data)
+except ImportError:
+    import json
 
-Package = namedtuple('Package', 'name requires type')
+    def dump_json(obj, fp):
+        json.dump(obj, fp, indent=2, separators=(',', ': '))
+        fp.write('\n')
+
+
+logger = logging.getLogger(__name__)
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+
+def intern_or_none(value):
+    return intern(value) if value is not None else None
+
+
+def sort_key(value):
+    # Order None before strings, as Python 2 did.
+    if isinstance(value, tuple):
+        return tuple(sort_key(item) for item in value)
+    return (value is not None, value)
 
 
 class Comps(dict):
 
-    def _parse_node(self, node):
-        node_id = node.find('id').text
-        node_data = {}
+    ATTRS = ()
+    _ATTR_SET = frozenset(ATTRS)
 
-        names = {}
-        for name in node.iter('name'):
-            attrs = name.items()
-            # XXX: No other attributes?
-            lang = attrs[0][1] if attrs else None
-            assert lang not in names
-            names[lang] = name.text
-        node_data['names'] = names
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._ATTR_SET = frozenset(cls.ATTRS)
+
+    def _parse_child(self, child, node_data):
+        pass
 
+    def _index_node(self, node_id, node_data):
+        pass
+
+    def _parse_node(self, node):
+        node_id = None
+        names = {}
         descriptions = {}
-        for desc in node.iter('description'):
-            attrs = desc.items()
-            # XXX: No other attributes?
-            lang = attrs[0][1] if attrs else None
-            assert lang not in descriptions
-            descriptions[lang] = desc.text
-        node_data['descriptions'] = descriptions
+        node_data = {'names': names, 'descriptions': descriptions}
+
+        for child in node:
+            tag = child.tag
+            if tag == 'name':
+                lang = intern_or_none(child.get(XML_LANG))
+                if lang in names:
+                    self.duplicate_translations += 1
+                else:
+                    names[lang] = child.text
+            elif tag == 'description':
+                lang = intern_or_none(child.get(XML_LANG))
+                if lang in descriptions:
+                    self.duplicate_translations += 1
+                else:
+                    descriptions[lang] = child.text
+            elif tag == 'id':
+                node_id = child.text
+            elif tag in self._ATTR_SET:
+                node_data[intern(tag)] = child.text
+            else:
+                self._parse_child(child, node_data)
 
         return node_id, node_data
 
-    def _parse(self, tag):
-        start = time.clock()
-        for node in self._xmlroot.iter(tag):
-            node_id, node_data = self._parse_node(node)
-            assert node_id not in self
-            self[node_id] = node_data
-        elapsed = time.clock() - start
-        logging.debug("parsed '%s:%s' in %g seconds", self.filename, tag, elapsed)
-
-    def __init__(self, xmlroot, filename):
-        super(Comps, self).__init__()
-        self._xmlroot = xmlroot
+    def add_node(self, node):
+        node_id, node_data = self._parse_node(node)
+        # The first node with a given id wins, later ones are only counted.
+        if self.setdefault(node_id, node_data) is not node_data:
+            self.duplicates += 1
+            return
+        self._index_node(node_id, node_data)
+
+    def __init__(self, filename):
+        super().__init__()
         self.filename = filename
+        self.duplicates = 0
+        self.duplicate_translations = 0
 
 
 class Groups(Comps):
 
+    TAG = 'group'
     ATTRS = ('default', 'uservisible', 'langonly')
 
-    def _parse_node(self, node):
-        group_id, group_data = super(Groups, self)._parse_node(node)
-
-        for tag in self.ATTRS:
-            element = node.find(tag)
-            if element is not None:
-                group_data[tag] = element.text
-
-        packagelist = node.find('packagelist')
-        if packagelist is not None:
+    def _parse_child(self, child, group_data):
+        if child.tag == 'packagelist':
+            # (name, requires, type) tuples.
             packages = []
-            for package in packagelist.iter('packagereq'):
-                packages.append(Package(name=package.text,
-                                        requires=package.get('requires'),
-                                        type=package.get('type')))
+            for packagereq in child.iter('packagereq'):
+                name = packagereq.text
+                requires = intern_or_none(packagereq.get('requires'))
+                type_ = intern_or_none(packagereq.get('type'))
+                packages.append((name, requires, type_))
             group_data['packages'] = packages
 
-        return group_id, group_data
+    def _index_node(self, group_id, group_data):
+        for name, requires, type_ in group_data.get('packages', ()):
+            self._pkgacc[name].add((group_id, requires, type_))
 
-    def parse(self):
-        self._parse(tag='group')
+    def __init__(self, filename):
+        super().__init__(filename)
+        self._pkgacc = defaultdict(set)
 
     @property
     def packages(self):
-        if not hasattr(self, '_pkgacc'):
-            self._pkgacc = defaultdict(set)
-            for group_id in self:
-                packages = self[group_id]['packages']
-                for package in packages:
-                    pkgtup = (group_id, package.requires, package.type)
-                    self._pkgacc[package.name].add(pkgtup)
         return self._pkgacc
 
 
 class Categories(Comps):
 
+    TAG = 'category'
     ATTRS = ('display_order',)
 
-    def _parse_node(self, node):
-        category_id, category_data = super(Categories, self)._parse_node(node)
-
-        for tag in self.ATTRS:
-            element = node.find(tag)
-            if element is not None:
-                category_data[tag] = element.text
-
-        grouplist = node.find('grouplist')
-        if grouplist is not None:
+    def _parse_child(self, child, category_data):
+        if child.tag == 'grouplist':
             groups = []
-            for group in grouplist.iter('groupid'):
+            for group in child.iter('groupid'):
                 groups.append(group.text)
             category_data['groups'] = groups
 
-        return category_id, category_data
+    def _index_node(self, category_id, category_data):
+        for group in category_data.get('groups', ()):
+            self._grpacc[group].add(category_id)
 
-    def parse(self):
-        self._parse(tag='category')
+    def __init__(self, filename):
+        super().__init__(filename)
+        self._grpacc = defaultdict(set)
 
     @property
     def groups(self):
-        if not hasattr(self, '_grpacc'):
-            self._grpacc = defaultdict(set)
-            for category_id in self:
-                groups = self[category_id]['groups']
-                for group in groups:
-                    self._grpacc[group].add(category_id)
         return self._grpacc
 
 
@@ -135,41 +168,77 @@ def parse_args(args=None):
     return parser.parse_args(args) if args else parser.parse_args()
 
 
-def parse_xml(filename):
-    start = time.clock()
-    tree = ElementTree.parse(filename)
-    elapsed = time.clock() - start
-    logging.debug('opened %s in %g seconds', filename, elapsed)
-    return tree.getroot()
+def parse_comps(filename, groups, categories):
+    comps = {groups.TAG: groups, categories.TAG: categories}
+    start = perf_counter()
+    root, depth = None, 0
+    for event, elem in ElementTree.iterparse(filename,
+                                             events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 1:
+            # Top level element is complete, parse it and drop it
+            # from the tree to keep memory usage flat.
+            if elem.tag in comps:
+                comps[elem.tag].add_node(elem)
+            root.clear()
+    elapsed = perf_counter() - start
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('parsed %s in %g seconds', filename, elapsed)
+
+    for tag, nodes in comps.items():
+        if nodes.duplicates:
+            logger.warning('%s: %d duplicate %s ids', filename,
+                           nodes.duplicates, tag)
+        if nodes.duplicate_translations:
+            logger.warning('%s: %d duplicate %s translations', filename,
+                           nodes.duplicate_translations, tag)
 
 
 def diff_comps(source, target, attributes):
 
     def diff_dicts(source_dict, target_dict):
-        additions = set((key, target_dict[key]) for key in target_dict
-                        if key not in source_dict)
-        removals, changes = set(), set()
-        for key, value in source_dict.iteritems():
-            if key not in target_dict:
-                removals.add(key)
-                continue
-            if not value == target_dict[key]:
-                changes.add((key, value, target_dict[key]))
+        source_keys = source_dict.keys()
+        target_keys = target_dict.keys()
+        additions = target_keys - source_keys
+        removals = source_keys - target_keys
+        changes = set()
+        for key in source_keys & target_keys:
+            value, target_value = source_dict[key], target_dict[key]
+            if value is not target_value and value != target_value:
+                changes.add(key)
         return additions, removals, changes
 
-    diff = defaultdict(list)
+    def diff_texts(tag, source_data, target_data):
+        additions, removals, changes = diff_dicts(source_data[tag],
+                                                  target_data[tag])
+        return {tag: {'new': sorted(additions | changes, key=sort_key),
+                      'removed': sorted(removals, key=sort_key)}}
+
+    diff = {}
 
     for node_id in target:
         if node_id not in source:
-            diff[node_id].append('new')
+            diff[node_id] = ['new']
 
-    for node_id, source_data in source.iteritems():
+    for node_id, source_data in source.items():
         if node_id not in target:
-            diff[node_id].append('removed')
+            diff[node_id] = ['removed']
             continue
 
         target_data = target[node_id]
 
+        if source_data == target_data:
+            # Unchanged node, skip the per-field comparison.
+            diff[node_id] = [{}, {'names': {'new': [], 'removed': []}},
+                             {'descriptions': {'new': [], 'removed': []}}]
+            continue
+
         # Attributes.
         attr_dict = {}
         for attr in attributes:
@@ -177,32 +246,27 @@ def diff_comps(source, target, attributes):
             target_value = target_data.get(attr)
             if source_value != target_value:
                 attr_dict[attr] = target_value
-        diff[node_id].append(attr_dict)
 
         # Names and descriptions.
-        for tag in ('names', 'descriptions'):
-            additions, removals, changes = diff_dicts(source_data[tag],
-                                                      target_data[tag])
-            new = map(itemgetter(0), additions | changes)
-            diff[node_id].append({tag: {'new': sorted(new),
-                                        'removed': sorted(removals)}})
+        diff[node_id] = [attr_dict,
+                         diff_texts('names', source_data, target_data),
+                         diff_texts('descriptions', source_data, target_data)]
 
     return diff
 
 
 def diff_list(source, target):
-    diff = defaultdict(list)
+    diff = {}
 
-    for item, groups in target.iteritems():
+    for item, groups in target.items():
         if item not in source:
             # New item.
-            diff[item].append({'new': sorted(groups)})
+            diff[item] = [{'new': sorted(groups, key=sort_key)}]
 
-    for item, groups in source.iteritems():
+    for item, groups in source.items():
         if item not in target:
             # Completely removed item.
-            diff[item].append({'removed':
-                               sorted(map(itemgetter(0), groups))})
+            diff[item] = [{'removed': sorted(entry[0] for entry in groups)}]
             continue
 
         # Compare.
@@ -210,31 +274,30 @@ def diff_list(source, target):
         if not (groups == target_groups):
             additions = target_groups - groups
             removals = groups - target_groups
+            changes = []
             if additions:
-                diff[item].append({'new': sorted(additions)})
+                changes.append({'new': sorted(additions, key=sort_key)})
             if removals:
-                diff[item].append({'removed':
-                                   sorted(map(itemgetter(0), removals))})
+                changes.append({'removed':
+                                sorted(entry[0] for entry in removals)})
+            diff[item] = changes
 
     return diff
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
     args = parse_args()
-    source_xml = parse_xml(args.source)
-    target_xml = parse_xml(args.target)
 
-    source_groups = Groups(source_xml, args.source)
-    source_groups.parse()
-    target_groups = Groups(target_xml, args.target)
-    target_groups.parse()
+    source_groups = Groups(args.source)
+    source_categories = Categories(args.source)
+    parse_comps(args.source, source_groups, source_categories)
 
-    source_categories = Categories(source_xml, args.source)
-    source_categories.parse()
-    target_categories = Categories(target_xml, args.target)
-    target_categories.parse()
+    target_groups = Groups(args.target)
+    target_categories = Categories(args.target)
+    parse_comps(args.target, target_groups, target_categories)
 
-    start = time.clock()
+    start = perf_counter()
 
     groups_diff = diff_comps(source_groups, target_groups, Groups.ATTRS)
     packages_diff = diff_list(source_groups.packages, target_groups.packages)
@@ -243,10 +306,10 @@ if __name__ == '__main__':
     grouplist_diff = diff_list(source_categories.groups,
                                target_categories.groups)
 
-    elapsed = time.clock() - start
-    logging.debug('diffed in %g seconds', elapsed)
+    elapsed = perf_counter() - start
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('diffed in %g seconds', elapsed)
 
-    print json.dumps({'groups': groups_diff, 'packagelist': packages_diff,
-                      'categories': categories_diff,
-                      'grouplist': grouplist_diff},
-                     indent=4, separators=(',', ': '))
+    dump_json({'groups': groups_diff, 'packagelist': packages_diff,
+               'categories': categories_diff, 'grouplist': grouplist_diff},
+              sys.stdout)